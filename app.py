@@ -1,23 +1,81 @@
+import hashlib
 import io
 import json
+import math
+import multiprocessing
 import os
+import queue
 import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from typing import Iterator, List, Tuple
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
 
+import numpy as np
+import pikepdf
 import streamlit as st
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LAParams, LTTextContainer
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
 from PIL import Image
-from PyPDF2 import PdfReader, PdfWriter
-from pdf2image import convert_from_bytes
 import pytesseract
 from streamlit.components.v1 import html
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+
+from ocr_worker import (
+    PageResult,
+    PdfChunk,
+    RenderedChunk,
+    TesseractMissingError,
+    binarize_page_file,
+    create_tess_api,
+    init_worker,
+    parse_tesseract_config,
+    preprocess_for_ocr,
+    rasterize_and_ocr,
+    render_chunk,
+    run_text_and_pdf,
+    tesserocr_image_to_string,
+    tesserocr_usable,
+    with_tesseract_dpi,
+)
 
 MAX_PAGES_PER_CHUNK = 8
-PDF2IMAGE_THREAD_LIMIT = max(1, min(4, os.cpu_count() or 1))
+PDF2IMAGE_THREAD_LIMIT = max(1, min(8, os.cpu_count() or 1))
+# Every OCR click starts its own pool, so keep concurrent sessions from each claiming every core.
+OCR_WORKER_COUNT = max(1, min(8, os.cpu_count() or 1))
 FAST_MODE_MAX_DPI = 220
+MAX_OCR_IMAGE_DIMENSION = 3500
+PREFETCH_DEPTH = 2
 FAST_TESSERACT_CONFIG = "--oem 3 --psm 6"
 DEFAULT_TESSERACT_CONFIG = ""
+NO_DICTIONARY_CONFIG = "-c load_system_dawg=0 -c load_freq_dawg=0"
+NO_INVERT_CONFIG = "-c tessedit_do_invert=0"
 USE_PDF_PAGE_EXTRACT = True
+OCR_CACHE_MAX_ENTRIES = 512
+# Page PDFs embed the raster (often 1-3 MB each), so the cache is also bounded by size.
+OCR_CACHE_MAX_BYTES = 128 * 1024 * 1024
+NATIVE_TEXT_MIN_CHARS = 50
+# Content-stream operators that paint text; a page without any of them is a scan.
+TEXT_SHOWING_OPERATORS = "Tj TJ ' \""
+# Decoded uploads can be hundreds of MB each, so keep only a few recent ones.
+IMAGE_CACHE_MAX_ENTRIES = 4
+IMAGE_CACHE_TTL_SECONDS = 30 * 60
+TESS_API_LOCK = threading.Lock()
+DOWNLOAD_DIR = os.path.join(tempfile.gettempdir(), "ocr_downloads")
+# Generated PDFs whose download never ran (failed auto-click, closed tab) are deleted after this long.
+DOWNLOAD_FILE_MAX_AGE_SECONDS = 60 * 60
+# Forking the multi-threaded Streamlit server can deadlock the child on locks held by
+# other threads (logging, caches, Tornado), so workers start from a clean process.
+POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+T = TypeVar("T")
 
 
 def detect_default_tesseract_cmd() -> str:
@@ -45,29 +103,242 @@ def detect_default_tesseract_cmd() -> str:
     return ""
 
 
+@st.cache_resource(show_spinner=False)
+def resolve_tesseract_cmd(cmd_path: str) -> str:
+    """Return the expanded executable path, or an empty string if it does not exist."""
+    tesseract_executable = Path(cmd_path).expanduser()
+    return str(tesseract_executable) if tesseract_executable.exists() else ""
+
+
 def configure_tesseract(cmd_path: str) -> None:
     """Optionally configure pytesseract with an explicit executable path."""
     if cmd_path:
-        tesseract_executable = Path(cmd_path).expanduser()
-        if tesseract_executable.exists():
-            pytesseract.pytesseract.tesseract_cmd = str(tesseract_executable)
+        resolved = resolve_tesseract_cmd(cmd_path)
+        if resolved:
+            pytesseract.pytesseract.tesseract_cmd = resolved
         else:
-            st.warning(f"Executavel nao encontrado em: {tesseract_executable}")
+            st.warning(f"Executavel nao encontrado em: {Path(cmd_path).expanduser()}")
 
 
-def get_tesseract_config(fast_mode: bool) -> str:
-    return FAST_TESSERACT_CONFIG if fast_mode else DEFAULT_TESSERACT_CONFIG
+@st.cache_resource(show_spinner=False)
+def get_installed_languages(tesseract_cmd: str) -> Tuple[str, ...]:
+    """List the language packs of the given executable; empty if it cannot be queried."""
+    try:
+        return tuple(pytesseract.get_languages(config=""))
+    except (pytesseract.TesseractNotFoundError, pytesseract.TesseractError, OSError):
+        return ()
+
+
+def find_missing_languages(lang: str, tesseract_cmd: str) -> List[str]:
+    installed = get_installed_languages(tesseract_cmd)
+    if not installed:
+        return []
+    return [code for code in lang.split("+") if code and code not in installed]
+
+
+def get_tesseract_config(fast_mode: bool, disable_dictionaries: bool = False, skip_inverted: bool = False) -> str:
+    parts = [FAST_TESSERACT_CONFIG if fast_mode else DEFAULT_TESSERACT_CONFIG]
+    if disable_dictionaries:
+        parts.append(NO_DICTIONARY_CONFIG)
+    if skip_inverted:
+        parts.append(NO_INVERT_CONFIG)
+    return " ".join(part for part in parts if part)
+
+
+class OcrPageCache:
+    """Thread-safe LRU of per-page OCR results shared by every session.
+
+    Bounded both by entry count and by the total length of the stored values.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Union[str, bytes]]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Union[str, bytes]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Union[str, bytes]) -> None:
+        size = len(value)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= len(previous)
+            if size > self._max_bytes:
+                return
+            self._entries[key] = value
+            self._total_bytes += size
+            while len(self._entries) > self._max_entries or self._total_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
 
 
-@st.cache_data(show_spinner=False)
-def load_pdf_bytes(uploaded_file) -> bytes:
-    return uploaded_file.getvalue()
+@st.cache_resource(show_spinner=False)
+def get_ocr_page_cache() -> OcrPageCache:
+    return OcrPageCache(OCR_CACHE_MAX_ENTRIES, OCR_CACHE_MAX_BYTES)
+
+
+def hash_file_bytes(file_bytes: bytes) -> str:
+    return hashlib.sha1(file_bytes).hexdigest()
+
+
+def ocr_cache_key(
+    file_hash: str,
+    page: int,
+    dpi: int,
+    lang: str,
+    config: str,
+    preprocess: bool,
+    mode: str,
+) -> Tuple[str, int, int, str, str, bool, str]:
+    return (file_hash, page, dpi, lang, config, preprocess, mode)
+
+
+@st.cache_resource(show_spinner=False)
+def get_tess_api(lang: str, psm: int, oem: int, variables: Tuple[Tuple[str, str], ...] = ()):
+    return create_tess_api(lang, psm, oem, variables)
+
+
+def ocr_image_to_string(image: Image.Image, lang: str, config: str) -> str:
+    """OCR a single image in-process with tesserocr when possible, else via pytesseract."""
+    tesseract_cmd = pytesseract.pytesseract.tesseract_cmd
+    init_args = parse_tesseract_config(config) if tesserocr_usable(tesseract_cmd) else None
+    if init_args is not None:
+        try:
+            api = get_tess_api(lang, *init_args)
+        except RuntimeError:
+            # Let pytesseract surface a proper TesseractError (e.g. missing language data).
+            api = None
+        if api is not None:
+            with TESS_API_LOCK:
+                return tesserocr_image_to_string(api, image)
+    return pytesseract.image_to_string(image, lang=lang, config=config)
+
+
+def native_text_cache_key(file_hash: str, page: int) -> Tuple[str, int, str]:
+    return (file_hash, page, "native")
+
+
+def find_text_pages(file_bytes: bytes, pages: List[int]) -> Dict[int, int]:
+    """Map the PDF object number of every page that draws text to its page number.
+
+    Only the content-stream operators are scanned, which is far cheaper than a
+    pdfminer layout pass; pages drawing no text are scans and skip pdfminer.
+    """
+    text_pages: Dict[int, int] = {}
+    with pikepdf.open(io.BytesIO(file_bytes)) as pdf:
+        for page_number in pages:
+            page = pdf.pages[page_number - 1]
+            try:
+                shows_text = bool(pikepdf.parse_content_stream(page.obj, TEXT_SHOWING_OPERATORS))
+            except pikepdf.PdfError:
+                shows_text = False
+            if shows_text:
+                text_pages[page.obj.objgen[0]] = page_number
+    return text_pages
+
+
+def extract_native_texts(file_bytes: bytes, text_pages: Dict[int, int]) -> Dict[int, str]:
+    """Lay out only the given pages with pdfminer and return their text by page number.
+
+    Pages are matched on their object number rather than their position, which
+    stays correct when pdfminer falls back to scanning objects for a broken page tree.
+    """
+    manager = PDFResourceManager()
+    device = PDFPageAggregator(manager, laparams=LAParams())
+    interpreter = PDFPageInterpreter(manager, device)
+    texts: Dict[int, str] = {}
+    for page in PDFPage.get_pages(io.BytesIO(file_bytes)):
+        page_number = text_pages.get(page.pageid)
+        if page_number is None:
+            continue
+        interpreter.process_page(page)
+        layout = device.get_result()
+        texts[page_number] = "".join(element.get_text() for element in layout if isinstance(element, LTTextContainer))
+        if len(texts) == len(text_pages):
+            break
+    return texts
+
+
+def get_native_texts(file_bytes: bytes, file_hash: str, pages: List[int]) -> Dict[int, str]:
+    """Return the embedded text of the pages that already carry a usable text layer.
+
+    Pages with fewer than NATIVE_TEXT_MIN_CHARS characters are treated as scans.
+    """
+    cache = get_ocr_page_cache()
+    native: Dict[int, str] = {}
+    unknown: List[int] = []
+    for page_number in sorted(set(pages)):
+        cached = cache.get(native_text_cache_key(file_hash, page_number))
+        if cached is None:
+            unknown.append(page_number)
+        elif cached:
+            native[page_number] = cached
+
+    if not unknown:
+        return native
+
+    texts: Dict[int, str] = {}
+    try:
+        with st.spinner("Verificando texto nativo do PDF..."):
+            text_pages = find_text_pages(file_bytes, unknown)
+            if text_pages:
+                texts = extract_native_texts(file_bytes, text_pages)
+    except Exception:
+        # A text layer pdfminer cannot parse just means those pages go through OCR.
+        return native
+    for page_number in unknown:
+        text = texts.get(page_number, "")
+        usable = text if len(text.strip()) >= NATIVE_TEXT_MIN_CHARS else ""
+        cache.put(native_text_cache_key(file_hash, page_number), usable)
+        if usable:
+            native[page_number] = usable
+    return native
+
+
+@st.cache_data(show_spinner=False, max_entries=IMAGE_CACHE_MAX_ENTRIES, ttl=IMAGE_CACHE_TTL_SECONDS)
+def open_image(file_bytes: bytes, mode: str) -> Image.Image:
+    with Image.open(io.BytesIO(file_bytes)) as image:
+        return image.convert(mode)
 
 
 @st.cache_data(show_spinner=False)
 def get_pdf_page_count(file_bytes: bytes) -> int:
-    reader = PdfReader(io.BytesIO(file_bytes))
-    return len(reader.pages)
+    with pikepdf.open(io.BytesIO(file_bytes)) as pdf:
+        return len(pdf.pages)
+
+
+@st.cache_data(show_spinner=False)
+def get_pdf_page_sizes(file_bytes: bytes) -> List[Tuple[float, float]]:
+    """Return the (width, height) of every page in inches, from its media box."""
+    sizes: List[Tuple[float, float]] = []
+    with pikepdf.open(io.BytesIO(file_bytes)) as pdf:
+        for page in pdf.pages:
+            x0, y0, x1, y1 = (float(value) for value in page.mediabox)
+            sizes.append((abs(x1 - x0) / 72, abs(y1 - y0) / 72))
+    return sizes
+
+
+def clamp_dpi(dpi: int, page_size: Tuple[float, float]) -> int:
+    """Cap the DPI so the rendered page stays within MAX_OCR_IMAGE_DIMENSION pixels."""
+    longest_side = max(page_size)
+    if longest_side <= 0:
+        return dpi
+    return max(1, min(dpi, int(MAX_OCR_IMAGE_DIMENSION / longest_side)))
+
+
+def limit_image_size(image: Image.Image) -> Image.Image:
+    """Downsample an image whose longest side exceeds MAX_OCR_IMAGE_DIMENSION pixels."""
+    if max(image.size) > MAX_OCR_IMAGE_DIMENSION:
+        image.thumbnail((MAX_OCR_IMAGE_DIMENSION, MAX_OCR_IMAGE_DIMENSION), Image.LANCZOS)
+    return image
 
 
 def build_page_selection(page_count: int) -> List[int]:
@@ -81,86 +352,295 @@ def build_page_selection(page_count: int) -> List[int]:
     return selected or []
 
 
-def iter_pdf_images(file_bytes: bytes, pages: List[int], dpi: int) -> Iterator[Tuple[int, Image.Image]]:
+def plan_pdf_chunks(
+    file_bytes: bytes,
+    pages: List[int],
+    dpi: int,
+    max_chunk_pages: int = MAX_PAGES_PER_CHUNK,
+) -> List[PdfChunk]:
+    """Group the pages into contiguous runs of at most ``max_chunk_pages`` rendered at the same (capped) DPI."""
     if not pages:
+        return []
+
+    ordered: List[int] = np.unique(np.asarray(pages, dtype=np.int32)).tolist()
+    page_sizes = get_pdf_page_sizes(file_bytes)
+    page_dpis = {page: clamp_dpi(dpi, page_sizes[page - 1]) for page in ordered}
+
+    chunks: List[PdfChunk] = []
+    chunk: List[int] = [ordered[0]]
+    for number in ordered[1:]:
+        if (
+            number == chunk[-1] + 1
+            and len(chunk) < max_chunk_pages
+            and page_dpis[number] == page_dpis[chunk[0]]
+        ):
+            chunk.append(number)
+        else:
+            chunks.append((chunk, page_dpis[chunk[0]]))
+            chunk = [number]
+    chunks.append((chunk, page_dpis[chunk[0]]))
+    return chunks
+
+
+@contextmanager
+def pdf_on_disk(file_bytes: bytes) -> Iterator[str]:
+    """Write the PDF to a temporary file once so Poppler loads it from disk for every chunk."""
+    with tempfile.TemporaryDirectory() as workdir:
+        pdf_path = os.path.join(workdir, "source.pdf")
+        with open(pdf_path, "wb") as pdf_file:
+            pdf_file.write(file_bytes)
+        yield pdf_path
+
+
+def iter_rendered_chunks(
+    file_bytes: bytes,
+    pages: List[int],
+    dpi: int,
+    preprocess: bool = False,
+) -> Iterator[RenderedChunk]:
+    """Render the pages chunk by chunk and yield each chunk's page files.
+
+    Every chunk gets its own temporary directory, which the consumer removes with
+    ``discard_rendered_chunk`` once it has finished with the files.
+    """
+    chunks = plan_pdf_chunks(file_bytes, pages, dpi)
+    if not chunks:
         return
 
-    unique_pages: List[int] = []
-    seen = set()
-    for page in pages:
-        if page not in seen:
-            unique_pages.append(page)
-            seen.add(page)
+    with pdf_on_disk(file_bytes) as pdf_path:
+        for chunk, chunk_dpi in chunks:
+            thread_count = min(len(chunk), PDF2IMAGE_THREAD_LIMIT)
+            chunk_dir = tempfile.mkdtemp(prefix="ocr_chunk_")
+            try:
+                image_paths = render_chunk(pdf_path, chunk[0], chunk[-1], chunk_dpi, thread_count, chunk_dir)
+                if preprocess:
+                    image_paths = [binarize_page_file(image_path, chunk_dpi) for image_path in image_paths]
+            except BaseException:
+                shutil.rmtree(chunk_dir, ignore_errors=True)
+                raise
+            yield list(zip(chunk, image_paths)), chunk_dpi, chunk_dir
 
-    if not unique_pages:
-        return
 
-    def contiguous_chunks(numbers: List[int]) -> Iterator[List[int]]:
-        chunk: List[int] = [numbers[0]]
-        for number in numbers[1:]:
-            if number == chunk[-1] + 1 and len(chunk) < MAX_PAGES_PER_CHUNK:
-                chunk.append(number)
-            else:
-                yield chunk
-                chunk = [number]
-        yield chunk
+def discard_rendered_chunk(rendered: RenderedChunk) -> None:
+    shutil.rmtree(rendered[2], ignore_errors=True)
 
-    ordered = sorted(unique_pages)
 
-    reader = PdfReader(io.BytesIO(file_bytes))
+class _PrefetchEnd:
+    def __init__(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
 
-    for chunk in contiguous_chunks(ordered):
-        first = chunk[0]
-        last = chunk[-1]
-        thread_count = min(len(chunk), PDF2IMAGE_THREAD_LIMIT)
-        writer = PdfWriter()
-        for page_number in chunk:
-            writer.add_page(reader.pages[page_number - 1])
-        buffer = io.BytesIO()
-        writer.write(buffer)
-        chunk_pdf_bytes = buffer.getvalue()
-        buffer.close()
-        chunk_images = convert_from_bytes(
-            chunk_pdf_bytes,
-            dpi=dpi,
-            first_page=1,
-            last_page=len(chunk),
-            grayscale=True,
-            thread_count=thread_count,
-        )
-        for offset, page_number in enumerate(chunk):
-            yield page_number, chunk_images[offset]
 
+def prefetch(
+    items: Iterator[T],
+    discard: Callable[[T], None],
+    depth: int = PREFETCH_DEPTH,
+) -> Iterator[T]:
+    """Produce items on a background thread, keeping up to ``depth`` ready.
+
+    Poppler and Tesseract both run as subprocesses, so rasterizing the next chunk
+    overlaps with OCR of the current one. Errors are re-raised in the consumer, and
+    items that are never handed out are released with ``discard``.
+    """
+    buffer: "queue.Queue[object]" = queue.Queue(maxsize=depth)
+    stop = threading.Event()
 
-def ocr_pdf_pages(file_bytes: bytes, pages: List[int], dpi: int, lang: str, config: str) -> List[Tuple[int, str]]:
-    results: List[Tuple[int, str]] = []
-    for page_number, image in iter_pdf_images(file_bytes, pages, dpi):
+    def offer(item: object) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        error: Optional[BaseException] = None
         try:
-            with st.spinner(f"Executando OCR na pagina {page_number}..."):
-                text = pytesseract.image_to_string(image, lang=lang, config=config)
+            for item in items:
+                if not offer(item):
+                    discard(item)
+                    break
+        except BaseException as exc:
+            error = exc
         finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+        offer(_PrefetchEnd(error))
+
+    def drain() -> None:
+        while True:
             try:
-                image.close()
-            except Exception:
-                pass
-        results.append((page_number, text))
-    return results
+                leftover = buffer.get_nowait()
+            except queue.Empty:
+                return
+            if not isinstance(leftover, _PrefetchEnd):
+                discard(leftover)
+
+    producer = threading.Thread(target=produce, name="pdf-prefetch", daemon=True)
+    add_script_run_ctx(producer)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if isinstance(item, _PrefetchEnd):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+    finally:
+        stop.set()
+        drain()
+        producer.join()
+        drain()
+
+
+def ocr_pdf_pages(
+    file_bytes: bytes,
+    file_hash: str,
+    pages: List[int],
+    dpi: int,
+    lang: str,
+    config: str,
+    preprocess: bool = False,
+    use_native_text: bool = True,
+) -> Iterator[Tuple[int, str]]:
+    """Yield ``(page_number, text)`` in page order as soon as each page is recognized.
+
+    Pages that already contain text are returned as-is when ``use_native_text`` is set.
+    """
+    cache = get_ocr_page_cache()
+    ordered = sorted(set(pages))
+    texts: Dict[int, str] = get_native_texts(file_bytes, file_hash, ordered) if use_native_text else {}
+    missing: List[int] = []
+    for page_number in ordered:
+        if page_number in texts:
+            continue
+        cached = cache.get(ocr_cache_key(file_hash, page_number, dpi, lang, config, preprocess, "text"))
+        if cached is None:
+            missing.append(page_number)
+        else:
+            texts[page_number] = cached
+
+    position = 0
+
+    def take_ready() -> Iterator[Tuple[int, str]]:
+        nonlocal position
+        while position < len(ordered) and ordered[position] in texts:
+            page_number = ordered[position]
+            position += 1
+            yield page_number, texts.pop(page_number)
+
+    def store(batch_results: List[PageResult]) -> None:
+        for page_number, text, page_pdf in batch_results:
+            cache.put(ocr_cache_key(file_hash, page_number, dpi, lang, config, preprocess, "text"), text)
+            # The same Tesseract run rendered the page PDF, so a later download needs no OCR.
+            if page_pdf is not None:
+                cache.put(ocr_cache_key(file_hash, page_number, dpi, lang, config, preprocess, "pdf"), page_pdf)
+            texts[page_number] = text
+
+    yield from take_ready()
+    if not missing:
+        return
 
+    # Workers run a single-threaded Tesseract, so split small jobs finely enough to keep every core busy.
+    chunk_pages = min(MAX_PAGES_PER_CHUNK, math.ceil(len(missing) / OCR_WORKER_COUNT))
+    chunks = plan_pdf_chunks(file_bytes, missing, dpi, chunk_pages)
+    with st.spinner(f"Executando OCR em {len(missing)} pagina(s)..."):
+        with pdf_on_disk(file_bytes) as pdf_path:
+            worker = partial(
+                rasterize_and_ocr,
+                pdf_path=pdf_path,
+                lang=lang,
+                config=config,
+                preprocess=preprocess,
+                tesseract_cmd=pytesseract.pytesseract.tesseract_cmd,
+            )
+            max_workers = min(OCR_WORKER_COUNT, len(chunks))
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context(POOL_START_METHOD),
+                initializer=init_worker,
+            ) as executor:
+                # Each worker renders and OCRs its own chunk, so Poppler and Tesseract
+                # both scale with the pool instead of funnelling through this process.
+                futures = [executor.submit(worker, chunk) for chunk in chunks]
+                try:
+                    for future in futures:
+                        try:
+                            batch_results = future.result()
+                        except TesseractMissingError:
+                            raise pytesseract.TesseractNotFoundError() from None
+                        store(batch_results)
+                        yield from take_ready()
+                finally:
+                    for future in futures:
+                        future.cancel()
+
+
+def build_searchable_pdf(
+    file_bytes: bytes,
+    file_hash: str,
+    pages: List[int],
+    dpi: int,
+    lang: str,
+    config: str,
+    preprocess: bool = False,
+    use_native_text: bool = True,
+) -> io.BytesIO:
+    """Build a PDF with a text layer for the selected pages.
+
+    Pages that already contain text are copied from the original when ``use_native_text`` is set.
+    """
+    cache = get_ocr_page_cache()
+    ordered = sorted(set(pages))
+    native_pages = set(get_native_texts(file_bytes, file_hash, ordered)) if use_native_text else set()
+    page_pdfs: Dict[int, bytes] = {}
+    missing: List[int] = []
+    for page_number in ordered:
+        if page_number in native_pages:
+            continue
+        cached = cache.get(ocr_cache_key(file_hash, page_number, dpi, lang, config, preprocess, "pdf"))
+        if cached is None:
+            missing.append(page_number)
+        else:
+            page_pdfs[page_number] = cached
 
-def build_searchable_pdf(file_bytes: bytes, pages: List[int], dpi: int, lang: str, config: str) -> io.BytesIO:
-    writer = PdfWriter()
-    for page_number, image in iter_pdf_images(file_bytes, pages, dpi):
+    rendered_chunks = iter_rendered_chunks(file_bytes, missing, dpi, preprocess)
+    for rendered in prefetch(rendered_chunks, discard_rendered_chunk):
+        page_files, chunk_dpi, _ = rendered
         try:
-            pdf_bytes = pytesseract.image_to_pdf_or_hocr(image, extension="pdf", lang=lang, config=config)
+            for page_number, image_path in page_files:
+                # Hand Tesseract the rendered file: a PIL image would be re-encoded as a
+                # quality-75 JPEG, and that second lossy copy is what the PDF would embed.
+                # The text comes out of the same run and is cached for "Executar OCR".
+                text, pdf_bytes = run_text_and_pdf(image_path, lang, with_tesseract_dpi(config, chunk_dpi))
+                cache.put(ocr_cache_key(file_hash, page_number, dpi, lang, config, preprocess, "text"), text)
+                cache.put(ocr_cache_key(file_hash, page_number, dpi, lang, config, preprocess, "pdf"), pdf_bytes)
+                page_pdfs[page_number] = pdf_bytes
         finally:
-            try:
-                image.close()
-            except Exception:
-                pass
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        writer.add_page(reader.pages[0])
-    buffer = io.BytesIO()
-    writer.write(buffer)
+            discard_rendered_chunk(rendered)
+
+    output = pikepdf.Pdf.new()
+    # qpdf copies page streams lazily, so the sources must stay open until save().
+    sources: List[pikepdf.Pdf] = []
+    try:
+        original = pikepdf.Pdf.open(io.BytesIO(file_bytes)) if native_pages else None
+        if original is not None:
+            sources.append(original)
+        for page_number in ordered:
+            if page_number in native_pages:
+                output.pages.append(original.pages[page_number - 1])
+                continue
+            source = pikepdf.Pdf.open(io.BytesIO(page_pdfs[page_number]))
+            sources.append(source)
+            output.pages.append(source.pages[0])
+        buffer = io.BytesIO()
+        output.save(buffer)
+    finally:
+        for source in sources:
+            source.close()
+        output.close()
     buffer.seek(0)
     return buffer
 
@@ -185,15 +665,64 @@ def auto_click_button(label: str) -> None:
     )
 
 
-def display_ocr_output(results: List[Tuple[int, str]]) -> None:
+def remove_download_file(path: Optional[str]) -> None:
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def remove_stale_download_files() -> None:
+    """Delete generated PDFs older than DOWNLOAD_FILE_MAX_AGE_SECONDS."""
+    cutoff = time.time() - DOWNLOAD_FILE_MAX_AGE_SECONDS
+    for path in Path(DOWNLOAD_DIR).glob("ocr_*.pdf"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+
+def store_pending_download(buffer: io.BytesIO, name: str) -> None:
+    """Spill the generated PDF to a temp file so session state only holds its path."""
+    # A previous PDF that was never downloaded would otherwise stay on disk.
+    remove_download_file(st.session_state.pop("download_file", None))
+    # Files from sessions that ended before their download ran are only caught here.
+    remove_stale_download_files()
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    buffer.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="ocr_", suffix=".pdf", dir=DOWNLOAD_DIR, delete=False) as pdf_file:
+        shutil.copyfileobj(buffer, pdf_file)
+    st.session_state["download_file"] = pdf_file.name
+    st.session_state["pending_download"] = {"path": pdf_file.name, "name": name}
+
+
+def release_pending_download(path: str) -> None:
+    """Download button callback: delete the temp PDF."""
+    remove_download_file(path)
+    if st.session_state.get("download_file") == path:
+        del st.session_state["download_file"]
+
+
+def display_ocr_page(page_number: int, text: str) -> None:
+    st.subheader(f"Resultado - Pagina {page_number}")
+    st.text_area(
+        label=f"OCR pagina {page_number}",
+        value=text,
+        height=min(400, max(120, len(text) // 2)),
+        key=f"text_page_{page_number}",
+    )
+
+
+def display_ocr_output(results: Iterable[Tuple[int, str]]) -> int:
+    """Render each result as it arrives and return how many pages were shown."""
+    shown = 0
     for page_number, text in results:
-        st.subheader(f"Resultado - Pagina {page_number}")
-        st.text_area(
-            label=f"OCR pagina {page_number}",
-            value=text,
-            height=min(400, max(120, len(text) // 2)),
-            key=f"text_page_{page_number}",
-        )
+        display_ocr_page(page_number, text)
+        shown += 1
+    return shown
 
 
 def main() -> None:
@@ -213,14 +742,38 @@ def main() -> None:
         value="por",
         help="Use os codigos Tesseract separados por '+', ex.: 'por+eng'. Certifique-se de que os pacotes estejam instalados.",
     )
+    missing_languages = find_missing_languages(lang, pytesseract.pytesseract.tesseract_cmd)
+    if missing_languages:
+        st.sidebar.warning(f"Idiomas nao instalados no Tesseract: {', '.join(missing_languages)}")
     dpi = st.sidebar.slider("Resolucao (DPI) para conversao de paginas", 150, 400, 250, step=50)
     fast_mode = st.sidebar.checkbox(
         "Modo rapido (menor precisao)",
         value=False,
         help="Reduz o DPI e usa configuracoes mais rapidas do Tesseract. Ideal para rascunhos.",
     )
+    preprocess = st.sidebar.checkbox(
+        "Preprocessar imagens",
+        value=False,
+        help="Binariza as paginas (limiar adaptativo) antes do OCR. Ajuda em digitalizacoes com ruido.",
+    )
+    use_native_text = st.sidebar.checkbox(
+        "Aproveitar texto nativo do PDF",
+        value=True,
+        help="Paginas que ja possuem texto sao usadas diretamente, sem OCR. Desative se o texto embutido estiver incorreto.",
+    )
+    with st.sidebar.expander("Avancado"):
+        disable_dictionaries = st.checkbox(
+            "Desativar dicionarios do Tesseract",
+            value=False,
+            help="Nao carrega os dicionarios de palavras. Mais rapido e melhor para codigos e numeros, pior para texto corrido.",
+        )
+        skip_inverted = st.checkbox(
+            "Ignorar texto invertido",
+            value=True,
+            help="Pula a verificacao de texto claro sobre fundo escuro.",
+        )
     effective_dpi = min(dpi, FAST_MODE_MAX_DPI) if fast_mode else dpi
-    tess_config = get_tesseract_config(fast_mode)
+    tess_config = get_tesseract_config(fast_mode, disable_dictionaries, skip_inverted)
     if fast_mode and effective_dpi != dpi:
         st.sidebar.caption(f"DPI limitado a {effective_dpi} no modo rapido.")
 
@@ -237,7 +790,8 @@ def main() -> None:
         file_suffix = uploaded_file.name.split(".")[-1].lower()
 
         if file_suffix == "pdf":
-            file_bytes = load_pdf_bytes(uploaded_file)
+            # The UploadedFile already holds the bytes; caching them would only add a copy.
+            file_bytes = uploaded_file.getvalue()
             try:
                 page_count = get_pdf_page_count(file_bytes)
             except Exception as exc:
@@ -254,6 +808,15 @@ def main() -> None:
             if selected_pages_sorted != selected_pages:
                 st.info("Paginas reordenadas para seguir a sequencia original do PDF.")
 
+            page_sizes = get_pdf_page_sizes(file_bytes)
+            page_dpis = [clamp_dpi(effective_dpi, page_sizes[page - 1]) for page in selected_pages_sorted]
+            clamped_dpis = [page_dpi for page_dpi in page_dpis if page_dpi < effective_dpi]
+            if clamped_dpis:
+                st.caption(
+                    f"DPI reduzido para ate {min(clamped_dpis)} em {len(clamped_dpis)} pagina(s) "
+                    f"para limitar as imagens a {MAX_OCR_IMAGE_DIMENSION} px."
+                )
+
             cols = st.columns(2)
             with cols[0]:
                 run_ocr = st.button("Executar OCR nas paginas selecionadas", type="primary", key="btn_visual_ocr")
@@ -264,15 +827,21 @@ def main() -> None:
                     key="btn_download_ocr",
                 )
 
+            if run_ocr or download_ocr_pdf:
+                file_hash = hash_file_bytes(file_bytes)
+
             if download_ocr_pdf:
                 try:
                     with st.spinner("Gerando PDF com OCR..."):
                         searchable_pdf = build_searchable_pdf(
                             file_bytes,
+                            file_hash,
                             selected_pages_sorted,
                             effective_dpi,
                             lang,
                             tess_config,
+                            preprocess,
+                            use_native_text,
                         )
                 except pytesseract.TesseractNotFoundError:
                     st.error("Tesseract nao encontrado. Ajuste o caminho na barra lateral ou instale o Tesseract.")
@@ -284,19 +853,22 @@ def main() -> None:
                     st.error(f"Falha ao gerar PDF com OCR. Verifique se o Poppler esta instalado. Erro: {exc}")
                     return
 
-                st.session_state["pending_download"] = {
-                    "data": searchable_pdf.getvalue(),
-                    "name": f"paginas_ocr_{uploaded_file.name}",
-                }
+                store_pending_download(searchable_pdf, f"paginas_ocr_{uploaded_file.name}")
+                searchable_pdf.close()
 
             if run_ocr:
                 try:
-                    results = ocr_pdf_pages(
-                        file_bytes,
-                        selected_pages_sorted,
-                        effective_dpi,
-                        lang,
-                        tess_config,
+                    shown = display_ocr_output(
+                        ocr_pdf_pages(
+                            file_bytes,
+                            file_hash,
+                            selected_pages_sorted,
+                            effective_dpi,
+                            lang,
+                            tess_config,
+                            preprocess,
+                            use_native_text,
+                        )
                     )
                 except pytesseract.TesseractNotFoundError:
                     st.error("Tesseract nao encontrado. Ajuste o caminho na barra lateral ou instale o Tesseract.")
@@ -308,37 +880,44 @@ def main() -> None:
                     st.error(f"Falha ao executar o OCR. Verifique se o Poppler esta instalado. Erro: {exc}")
                     return
 
-                if results:
-                    display_ocr_output(results)
-                else:
+                if not shown:
                     st.warning("Nenhuma pagina foi processada.")
 
             pending_download = st.session_state.pop("pending_download", None)
             if pending_download:
-                data = pending_download["data"]
+                path = pending_download["path"]
                 name = pending_download["name"]
                 st.success("PDF com OCR gerado. O download iniciara automaticamente.")
                 fallback_label = "Se o download nao iniciar, clique aqui"
-                st.download_button(
-                    fallback_label,
-                    data=data,
-                    file_name=name,
-                    mime="application/pdf",
-                    key="manual_download_fallback",
-                )
+                with open(path, "rb") as pdf_file:
+                    st.download_button(
+                        fallback_label,
+                        data=pdf_file,
+                        file_name=name,
+                        mime="application/pdf",
+                        key="manual_download_fallback",
+                        on_click=release_pending_download,
+                        args=(path,),
+                    )
                 auto_click_button(fallback_label)
 
         else:
             try:
-                image = Image.open(uploaded_file)
-                image = image.convert("L" if fast_mode else "RGB")
+                image = open_image(uploaded_file.getvalue(), "L" if fast_mode else "RGB")
             except Exception as exc:
                 st.error(f"Nao foi possivel abrir a imagem: {exc}")
                 return
 
             if st.button("Executar OCR na imagem", type="primary"):
                 try:
-                    text = pytesseract.image_to_string(image, lang=lang, config=tess_config)
+                    if max(image.size) > MAX_OCR_IMAGE_DIMENSION:
+                        st.caption(f"Imagem reduzida para no maximo {MAX_OCR_IMAGE_DIMENSION} px antes do OCR.")
+                        image = limit_image_size(image)
+                    if preprocess:
+                        processed = preprocess_for_ocr(image)
+                        image.close()
+                        image = processed
+                    text = ocr_image_to_string(image, lang, tess_config)
                     display_ocr_output([(1, text)])
                 except pytesseract.TesseractNotFoundError:
                     st.error("Tesseract nao encontrado. Ajuste o caminho na barra lateral ou instale o Tesseract.")
@@ -0,0 +1,339 @@
+"""Helpers executed inside OCR worker processes.
+
+These live outside ``app.py`` because Streamlit runs the app script as a
+synthetic ``__main__`` module, and functions defined there cannot be pickled
+for a ``ProcessPoolExecutor``.
+"""
+import importlib.util
+import io
+import os
+import shlex
+import shutil
+import tempfile
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+from pdf2image import convert_from_path
+import pikepdf
+import pytesseract
+
+PAGE_SEPARATOR = "\x0c"
+# tesserocr is imported lazily: libgomp reads OMP_THREAD_LIMIT when libtesseract
+# loads, so workers must set it (see init_worker) before the first import.
+TESSEROCR_AVAILABLE = importlib.util.find_spec("tesserocr") is not None
+
+# Ask the Tesseract CLI for both renderers so one recognition pass yields the text and the page PDF.
+TEXT_AND_PDF_CONFIG = "-c tessedit_create_txt=1 -c tessedit_create_pdf=1"
+
+PDF2IMAGE_JPEG_OPTIONS = {"quality": 85, "progressive": False, "optimize": False}
+# The PNGs only travel to Tesseract and are read once, so favour encode speed over size.
+PNG_COMPRESSION_LEVEL = 1
+
+TessInitArgs = Tuple[int, int, Tuple[Tuple[str, str], ...]]
+# Contiguous pages rendered together, and the DPI they are rendered at.
+PdfChunk = Tuple[List[int], int]
+# Rendered ``(page_number, image_path)`` pairs, their DPI, and the directory holding the files.
+RenderedChunk = Tuple[List[Tuple[int, str]], int, str]
+# ``(page_number, text, page_pdf)``; the PDF is None when tesserocr produced only text.
+PageResult = Tuple[int, str, Optional[bytes]]
+
+
+class TesseractMissingError(RuntimeError):
+    """Picklable stand-in for ``pytesseract.TesseractNotFoundError``.
+
+    The pytesseract exception takes no constructor arguments, so it cannot be
+    unpickled in the parent and would surface as ``BrokenProcessPool`` instead.
+    """
+
+
+def init_worker() -> None:
+    """Pool initializer: one single-threaded Tesseract per worker process."""
+    # Tesseract's OpenMP threads scale poorly and would oversubscribe a pool sized to the CPU count.
+    # Override any inherited value; this runs before tesserocr is imported in the worker.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def configure_worker(tesseract_cmd: str) -> None:
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+
+def tesserocr_usable(tesseract_cmd: str) -> bool:
+    """True if tesserocr may stand in for the configured Tesseract executable.
+
+    tesserocr links its own libtesseract and tessdata, so it is skipped when the
+    user points at a different executable; otherwise its version and language
+    packs could differ from the ones get_installed_languages reports.
+    """
+    if not TESSEROCR_AVAILABLE:
+        return False
+    if not tesseract_cmd:
+        return True
+    configured = shutil.which(tesseract_cmd)
+    default = shutil.which("tesseract")
+    if configured is None or default is None:
+        return False
+    return os.path.realpath(configured) == os.path.realpath(default)
+
+
+def with_tesseract_dpi(config: str, dpi: int) -> str:
+    """Tell Tesseract the render resolution so it skips its own estimate."""
+    return f"{config} --dpi {dpi}".strip()
+
+
+def preprocess_for_ocr(image: Image.Image) -> Image.Image:
+    """Binarize the image (blur + adaptive threshold) so Tesseract segments a clean bitonal page."""
+    arr = np.asarray(image)
+    gray = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY) if arr.ndim == 3 else arr
+    blur = cv2.GaussianBlur(gray, (3, 3), 0)
+    thresholded = cv2.adaptiveThreshold(
+        blur,
+        255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY,
+        31,
+        10,
+    )
+    return Image.fromarray(thresholded)
+
+
+def page_image_to_array(image: Image.Image) -> np.ndarray:
+    """Return the page as a contiguous single-channel ``uint8`` array."""
+    arr = np.asarray(image)
+    if arr.ndim == 3:
+        arr = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
+    return np.ascontiguousarray(arr, dtype=np.uint8)
+
+
+def render_chunk(pdf_path: str, first: int, last: int, dpi: int, thread_count: int, output_folder: str) -> List[str]:
+    """Render pages ``first..last`` to grayscale JPEGs in ``output_folder`` and return their paths."""
+    return convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        first_page=first,
+        last_page=last,
+        grayscale=True,
+        thread_count=thread_count,
+        fmt="jpeg",
+        jpegopt=PDF2IMAGE_JPEG_OPTIONS,
+        use_pdftocairo=True,
+        output_folder=output_folder,
+        paths_only=True,
+    )
+
+
+def load_page_image(image_path: str, dpi: int, preprocess: bool = False) -> Image.Image:
+    image = Image.open(image_path)
+    # Decode now so the rendered file can be removed while the image is still in use.
+    image.load()
+    if preprocess:
+        processed = preprocess_for_ocr(image)
+        image.close()
+        image = processed
+    image.info["dpi"] = (dpi, dpi)
+    return image
+
+
+def binarize_page_file(image_path: str, dpi: int) -> str:
+    """Binarize a rendered page and write it next to the original as PNG; return the new path."""
+    with load_page_image(image_path, dpi, preprocess=True) as image:
+        arr = page_image_to_array(image)
+    output_path = os.path.splitext(image_path)[0] + ".png"
+    if not cv2.imwrite(output_path, arr, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION_LEVEL]):
+        raise ValueError("Falha ao codificar a pagina em PNG.")
+    return output_path
+
+
+def parse_tesseract_config(config: str) -> Optional[TessInitArgs]:
+    """Translate a pytesseract config string into ``(psm, oem, variables)`` for tesserocr.
+
+    Returns None when the string holds options tesserocr cannot express, so the
+    caller can fall back to pytesseract.
+    """
+    psm, oem = 3, 3
+    variables: List[Tuple[str, str]] = []
+    tokens = shlex.split(config)
+    while tokens:
+        option = tokens.pop(0)
+        if option not in ("--psm", "--oem", "--dpi", "-c") or not tokens:
+            return None
+        value = tokens.pop(0)
+        if option == "--dpi":
+            if not value.isdigit():
+                return None
+            variables.append(("user_defined_dpi", value))
+        elif option == "-c":
+            name, separator, variable_value = value.partition("=")
+            if not separator:
+                return None
+            variables.append((name, variable_value))
+        elif not value.isdigit():
+            return None
+        elif option == "--psm":
+            psm = int(value)
+        else:
+            oem = int(value)
+    return psm, oem, tuple(variables)
+
+
+def create_tess_api(lang: str, psm: int, oem: int, variables: Tuple[Tuple[str, str], ...] = ()):
+    """Initialize a persistent in-process Tesseract API (requires tesserocr)."""
+    from tesserocr import PyTessBaseAPI
+
+    return PyTessBaseAPI(lang=lang, psm=psm, oem=oem, variables=dict(variables))
+
+
+@lru_cache(maxsize=4)
+def get_worker_api(lang: str, init_args: TessInitArgs):
+    """Per-process API cache; worker processes cannot use Streamlit's resource cache."""
+    psm, oem, variables = init_args
+    return create_tess_api(lang, psm, oem, variables)
+
+
+def tesserocr_image_to_string(api, image: Image.Image) -> str:
+    api.SetImage(image)
+    return api.GetUTF8Text()
+
+
+def tesserocr_file_to_string(api, image_path: str) -> str:
+    api.SetImageFile(image_path)
+    return api.GetUTF8Text()
+
+
+def run_text_and_pdf(input_path: str, lang: str, config: str) -> Tuple[str, bytes]:
+    """Run Tesseract once on an image file or list file; return its text and searchable PDF."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_base = os.path.join(tmpdir, "output")
+        pytesseract.pytesseract.run_tesseract(
+            input_path,
+            output_base,
+            extension=None,
+            lang=lang,
+            config=f"{config} {TEXT_AND_PDF_CONFIG}".strip(),
+        )
+        with open(output_base + ".txt", encoding="utf-8") as text_file:
+            text = text_file.read()
+        with open(output_base + ".pdf", "rb") as pdf_file:
+            pdf_bytes = pdf_file.read()
+    return text, pdf_bytes
+
+
+def ocr_one(item: Tuple[int, str], lang: str, config: str, tesseract_cmd: str = "") -> PageResult:
+    """Run Tesseract on a single page image file and return ``(page_number, text, page_pdf)``."""
+    configure_worker(tesseract_cmd)
+    page_number, image_path = item
+    # Hand Tesseract the rendered file directly; passing a PIL image would make
+    # pytesseract decode and re-encode it to a temporary image.
+    text, pdf_bytes = run_text_and_pdf(image_path, lang, config)
+    return page_number, text, pdf_bytes
+
+
+def split_pages(output: str, expected: int) -> Optional[List[str]]:
+    """Split multi-image Tesseract output on its form-feed page separator."""
+    parts = output.split(PAGE_SEPARATOR)
+    if len(parts) == expected + 1 and not parts[-1].strip():
+        parts = parts[:-1]
+    if len(parts) != expected:
+        return None
+    return parts
+
+
+def split_pdf_pages(pdf_bytes: bytes, expected: int) -> Optional[List[bytes]]:
+    """Split a multi-page Tesseract PDF into one single-page PDF per input image."""
+    with pikepdf.open(io.BytesIO(pdf_bytes)) as pdf:
+        if len(pdf.pages) != expected:
+            return None
+        page_pdfs: List[bytes] = []
+        for page in pdf.pages:
+            with pikepdf.new() as single:
+                single.pages.append(page)
+                buffer = io.BytesIO()
+                single.save(buffer)
+            page_pdfs.append(buffer.getvalue())
+    return page_pdfs
+
+
+def ocr_batch(batch: List[Tuple[int, str]], lang: str, config: str, tesseract_cmd: str = "") -> List[PageResult]:
+    """OCR several pages with a single Tesseract invocation using a list file.
+
+    The same run writes the text and the searchable PDF of every page. Falls back
+    to one invocation per page if Tesseract fails or its output cannot be matched
+    back to the input pages. When tesserocr is installed and matches the
+    configured executable, the pages are recognized in-process with a persistent
+    API instead, which yields text only.
+    """
+    configure_worker(tesseract_cmd)
+    init_args = parse_tesseract_config(config) if tesserocr_usable(tesseract_cmd) else None
+    if init_args is not None:
+        try:
+            api = get_worker_api(lang, init_args)
+        except RuntimeError:
+            # Let pytesseract surface a proper TesseractError (e.g. missing language data).
+            api = None
+        if api is not None:
+            results: List[PageResult] = []
+            for page_number, image_path in batch:
+                results.append((page_number, tesserocr_file_to_string(api, image_path), None))
+            return results
+
+    if len(batch) == 1:
+        return [ocr_one(batch[0], lang, config)]
+
+    texts: Optional[List[str]] = None
+    page_pdfs: Optional[List[bytes]] = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        list_path = os.path.join(tmpdir, "list.txt")
+        with open(list_path, "w", encoding="utf-8") as list_file:
+            list_file.write("\n".join(image_path for _, image_path in batch) + "\n")
+
+        try:
+            output, pdf_bytes = run_text_and_pdf(list_path, lang, config)
+        except (pytesseract.TesseractError, FileNotFoundError):
+            output = None
+        if output is not None:
+            texts = split_pages(output, len(batch))
+            page_pdfs = split_pdf_pages(pdf_bytes, len(batch)) if texts is not None else None
+
+    if texts is None or page_pdfs is None:
+        return [ocr_one(item, lang, config) for item in batch]
+    return [(page_number, text, page_pdf) for (page_number, _), text, page_pdf in zip(batch, texts, page_pdfs)]
+
+
+def rasterize_and_ocr(
+    chunk: PdfChunk,
+    pdf_path: str,
+    lang: str,
+    config: str,
+    preprocess: bool = False,
+    tesseract_cmd: str = "",
+) -> List[PageResult]:
+    """Render one chunk of the PDF and OCR it, entirely inside the worker process.
+
+    Raises TesseractMissingError if the Tesseract executable cannot be found.
+    """
+    try:
+        return _rasterize_and_ocr(chunk, pdf_path, lang, config, preprocess, tesseract_cmd)
+    except pytesseract.TesseractNotFoundError as exc:
+        raise TesseractMissingError(str(exc)) from None
+
+
+def _rasterize_and_ocr(
+    chunk: PdfChunk,
+    pdf_path: str,
+    lang: str,
+    config: str,
+    preprocess: bool,
+    tesseract_cmd: str,
+) -> List[PageResult]:
+    pages, dpi = chunk
+    with tempfile.TemporaryDirectory() as chunk_dir:
+        # The pool already runs one worker per core, so Poppler stays single-threaded here.
+        image_paths = render_chunk(pdf_path, pages[0], pages[-1], dpi, 1, chunk_dir)
+        # Tesseract reads pdftocairo's JPEGs as-is; pages are only decoded to be binarized.
+        if preprocess:
+            image_paths = [binarize_page_file(image_path, dpi) for image_path in image_paths]
+        batch = list(zip(pages, image_paths))
+        return ocr_batch(batch, lang, with_tesseract_dpi(config, dpi), tesseract_cmd)